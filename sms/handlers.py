@@ -1,11 +1,169 @@
-import json
-
-import requests
+import atexit
+import collections
+import functools
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+import urllib3
 import logging
 
 import sqlite3
 
 
+_INSERT_RESULT = "INSERT INTO Results VALUES (?, ?, ?, ?)"
+# types sqlite3 can bind, column affinity converts the rest (e.g. '3500' in integer column)
+_SQL_TYPES = (int, float, str, bytes)
+
+# no retries, like requests: a request dropped after it was sent must not send sms twice
+_HTTP = urllib3.PoolManager(
+    num_pools=4, maxsize=64, block=False,
+    retries=urllib3.Retry(total=None, connect=0, read=False, redirect=30, status=0, other=0)
+)
+
+_CONN_CACHE = {}
+_CACHE_LOCK = threading.Lock()
+_LOGGERS = weakref.WeakSet()
+_ORPHANS = collections.deque()
+
+
+def _is_shared(db_uri):
+    """
+    In-memory databases are private to a connection, so they are never shared
+    """
+    return ':memory:' not in db_uri and 'mode=memory' not in db_uri
+
+
+def _open(db_uri):
+    conn = sqlite3.connect(db_uri, uri=True, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+
+def _file_id(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_dev, st.st_ino
+
+
+def _connect(db_uri):
+    """
+    Return SQLite connection for db_uri and the lock guarding its transactions
+
+    Connections to a database file are shared between all loggers using it.
+    A cached connection is replaced when its file was removed or recreated.
+    """
+    if not _is_shared(db_uri):
+        return _open(db_uri), threading.Lock()
+    with _CACHE_LOCK:
+        entry = _CONN_CACHE.get(db_uri)
+        if entry is not None and _file_id(entry[2]) != entry[3]:
+            # the old connection is closed once no logger refers to it
+            entry = None
+        if entry is None:
+            conn = _open(db_uri)
+            path = conn.execute('PRAGMA database_list').fetchone()[2]
+            entry = _CONN_CACHE[db_uri] = (conn, threading.Lock(), path, _file_id(path))
+    return entry[0], entry[1]
+
+
+def _store(db_uri, conn, lock, rows):
+    """
+    Write rows in a single transaction and return connection and lock used for it
+
+    Shared connection is looked up again first, in case its file was replaced.
+    Rows that could not be written are logged and dropped.
+    """
+    try:
+        if _is_shared(db_uri):
+            conn, lock = _connect(db_uri)
+        with lock, conn:
+            conn.executemany(_INSERT_RESULT, rows)
+    except sqlite3.Error:
+        logging.getLogger('sms').exception('Could not store %d results, they are dropped', len(rows))
+    return conn, lock
+
+
+def _orphan(db_uri, conn, rows):
+    """
+    Queue results of collected SQLite logger
+
+    It may run inside garbage collection, where taking locks or doing I/O could deadlock,
+    so the rows are written later by `_store_orphans`
+    """
+    if rows:
+        _ORPHANS.append((db_uri, conn, rows))
+
+
+def _store_orphans():
+    while True:
+        try:
+            db_uri, conn, rows = _ORPHANS.popleft()
+        except IndexError:
+            return
+        _store(db_uri, conn, threading.Lock(), rows)
+
+
+def _flush_loggers():
+    """
+    Write results still buffered by alive and collected SQLite loggers
+    """
+    for logger in list(_LOGGERS):
+        try:
+            logger.flush()
+        except Exception:
+            logging.getLogger('sms').exception('Could not flush SQLite logger')
+    _store_orphans()
+
+
+@atexit.register
+def close_connections():
+    """
+    Flush SQLite loggers and close all shared connections
+
+    Loggers open a new connection on their next write
+    """
+    _flush_loggers()
+    with _CACHE_LOCK:
+        entries = list(_CONN_CACHE.values())
+        _CONN_CACHE.clear()
+    for conn, lock, _, _ in entries:
+        with lock:
+            conn.close()
+
+
+def _fields(data):
+    """
+    Encode request data the way requests did: None values are skipped, lists are sent as repeated keys
+    """
+    fields = []
+    for key, value in data.items():
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            fields.extend((key, item) for item in value)
+        else:
+            fields.append((key, value))
+    return fields
+
+
+def _result_args(result):
+    """
+    Unpack result parsed from sms service response into `_log` arguments
+    """
+    return result.get('status'), result.get('phone'), result.get('error_code'), result.get('error_msg')
+
+
 class BaseSMSHandler:
     """
     Interface for SMSHandlers
@@ -35,15 +193,42 @@ class BaseSMSHandler:
         """
         raise NotImplementedError
 
-    def _log(self, result):
+    def send_many(self, user_datas, concurrency=32):
+        """
+        Sending a batch of sms concurrently via sms service
+
+        user_datas -- iterable of dicts accepted by `send`
+        concurrency -- maximum number of requests in flight
+        """
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                list(executor.map(self.send, user_datas))
+        finally:
+            self.flush()
+
+    def flush(self):
+        """
+        Write results buffered by logging, nothing to do by default
+        """
+
+    def _log(self, status, phone, error_code=None, error_msg=None):
         """
         Internal method for logging result of `send` method
 
-        response -- it's a dict with 2 variants of data:
+        status -- 'ok' or 'error'
+        phone -- phone number of recipient
+        error_code -- code of error from sms service, only for 'error' status
+        error_msg -- description of error, only for 'error' status
+        """
+        raise NotImplementedError
+
+    def _log_dict(self, result):
+        """
+        Logging result of `send` method given as a dict with 2 variants of data:
             {'status':'ok','phone':'79149009900'}
             {'status':'error','phone':'79149009900','error_code':3500,'error_msg':'description'}
         """
-        raise NotImplementedError
+        self._log(*_result_args(result))
 
 
 class SimpleLoggingMixin:
@@ -51,20 +236,24 @@ class SimpleLoggingMixin:
     Logging result of call `send` method use standard python library 
     """
 
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.logger = logging.getLogger('sms')
+    logger = logging.getLogger('sms')
+
+    def _log_ok(self, phone, error_code, error_msg):
+        self.logger.info('status: OK, phone: %s', phone)
+
+    def _log_error(self, phone, error_code, error_msg):
+        self.logger.info('status: ERROR, phone: %s, message: %s', phone, error_msg)
+
+    _DISPATCH = {'ok': _log_ok, 'error': _log_error}
 
-    def _log(self, result):
-        status = result.get('status')
+    def _log(self, status, phone, error_code=None, error_msg=None):
         if status is None:
             raise ValueError('Could not find "status" field')
-        elif status == 'ok':
-            self.logger.info('status: OK, phone: %s', result['phone'])
-        elif status == 'error':
-            self.logger.info('status: ERROR, phone: %s, message: %s', result['phone'], result['error_msg'])
-        else:
+        log = self._DISPATCH.get(status)
+        if log is None:
             raise RuntimeError('Unexpected value of status')
+        if self.logger.isEnabledFor(logging.INFO):
+            log(self, phone, error_code, error_msg)
 
 
 class SQLiteLoggingMixin:
@@ -81,28 +270,55 @@ class SQLiteLoggingMixin:
     )
     """
 
-    def __init__(self, db_uri, **kwargs):
+    def __init__(self, db_uri, batch_size=500, **kwargs):
         """
         db_uri must contains URI path to SQLite file
         Example: file:path/to/database?mode=rw'
+        batch_size -- number of results buffered before they are written in one transaction
         """
         super().__init__(**kwargs)
-        conn = sqlite3.connect(db_uri, uri=True)
-        self.c = conn.cursor()
-
-    def _log(self, response):
-        status = response.get('status')
+        self._db_uri = db_uri
+        self.conn, self._conn_lock = _connect(db_uri)
+        self._buf = []
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        _LOGGERS.add(self)
+        # in-memory database lives only as long as its connection, so keep it for the orphaned rows
+        conn = None if _is_shared(db_uri) else self.conn
+        weakref.finalize(self, _orphan, db_uri, conn, self._buf).atexit = False
+
+    _SUCCESS = {'ok': 1, 'error': 0}
+
+    def _log(self, status, phone, error_code=None, error_msg=None):
         if status is None:
             raise ValueError('Could not find "status" field')
-        elif status == 'ok':
-            self.c.execute("INSERT INTO Results VALUES (?, ?, NULL, NULL)", (1, response['phone']))
-            self.c.connection.commit()
-        elif status == 'error':
-            self.c.execute("INSERT INTO Results VALUES (?, ?, ?, ?)",
-                           (0, response['phone'], response['error_code'], response['error_msg']))
-            self.c.connection.commit()
-        else:
+        success = self._SUCCESS.get(status)
+        if success is None:
             raise ValueError('Unexpected value of status')
+        if phone is None:
+            raise ValueError('Could not find "phone" field')
+        if not (error_code is None or isinstance(error_code, _SQL_TYPES)):
+            raise ValueError('Unexpected value of error_code')
+        if not (error_msg is None or isinstance(error_msg, _SQL_TYPES)):
+            raise ValueError('Unexpected value of error_msg')
+        with self._lock:
+            self._buf.append((success, phone, error_code, error_msg))
+            if len(self._buf) >= self._batch_size:
+                self._write()
+
+    def _write(self):
+        _store_orphans()
+        rows = self._buf[:]
+        self._buf.clear()
+        if rows:
+            self.conn, self._conn_lock = _store(self._db_uri, self.conn, self._conn_lock, rows)
+
+    def flush(self):
+        """
+        Write all buffered results to the database in a single transaction
+        """
+        with self._lock:
+            self._write()
 
 
 class SMSCRU_SMSHandlerMixin:
@@ -117,20 +333,17 @@ class SMSCRU_SMSHandlerMixin:
 
     request_url = 'http://smsc.ru/someapi/message/'
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._base_params = {'login': self.login, 'psw': self.password}
+
     def send(self, user_data):
-        params = {'login': self.login, 'psw': self.password}
-        params.update(user_data)
-        r = requests.get(self.request_url, params=params)
-        if r.status_code != 200:
-            self._log({
-                'status': 'error',
-                'phone': user_data.get('phone', '-'),
-                'error_code': None,
-                'error_msg': 'data: {}'.format(user_data)
-            })
+        params = {**self._base_params, **user_data}
+        r = _HTTP.request('GET', self.request_url, fields=_fields(params))
+        if r.status != 200:
+            self._log('error', user_data.get('phone', '-'), None, f'data: {user_data}')
         else:
-            response = r.json()
-            self._log(response)
+            self._log(*_result_args(_json.loads(r.data)))
 
 
 class SMSTRAFFIC_SMSHandlerMixin:
@@ -149,34 +362,37 @@ class SMSTRAFFIC_SMSHandlerMixin:
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.token = self._get_token()
+        self._base_data = {'token': self.token}
 
     def _get_token(self):
         data = {
             'login': self.login,
             'pass': self.password
         }
-        r = requests.post(self.auth_url, data=data)
-        if r.status_code != 200:
-            raise RuntimeError('Invalid response status code: {} != 200'.format(r.status_code))
-        token = json.loads(r.text).get('token')
+        r = _HTTP.request('POST', self.auth_url, fields=_fields(data), encode_multipart=False)
+        if r.status != 200:
+            raise RuntimeError('Invalid response status code: {} != 200'.format(r.status))
+        token = _json.loads(r.data).get('token')
         if token is None:
             raise RuntimeError('Response from server does not contain token')
         return token
 
     def send(self, user_data):
-        data = {'token': self.token}
-        data.update(user_data)
-        r = requests.post(self.request_url, data=data)
-        if r.status_code != 200:
-            self._log({
-                'status': 'error',
-                'phone': user_data.get('phone', '-'),
-                'error_code': None,
-                'error_msg': 'data: {}'.format(user_data)
-            })
+        data = {**self._base_data, **user_data}
+        r = _HTTP.request('POST', self.request_url, fields=_fields(data), encode_multipart=False)
+        if r.status != 200:
+            self._log('error', user_data.get('phone', '-'), None, f'data: {user_data}')
         else:
-            response = json.loads(r.text)
-            self._log(response)
+            self._log(*_result_args(_json.loads(r.data)))
+
+
+@functools.lru_cache(maxsize=None)
+def _compose(handler, logger):
+    """
+    Build sms handler class from handler and logger mixins, once per pair
+    """
+    class_name = handler.__name__[:-len('Mixin')]
+    return type(class_name, (logger, handler, BaseSMSHandler), {})
 
 
 def get_handler(handler_name, logger_name='simple', handler_data=None):
@@ -204,13 +420,7 @@ def get_handler(handler_name, logger_name='simple', handler_data=None):
     logger = loggers.get(logger_name)
     if handler is None or logger is None:
         raise ValueError('Invalid handler_name or logger_name')
-    class_name = handler.__name__[:-len('Mixin')]
-    cls = type(class_name, (logger, handler, BaseSMSHandler), {})
-    initial_data = {}
-    initial_data.update(auth_data)
+    cls = _compose(handler, logger)
     if handler_data is None:
-        handler_data = {}
-        if logger_name == 'sqlite':
-            handler_data = {'db_uri': 'file:/tmp/testdb.sqlite?mode=rw'}
-    initial_data.update(handler_data)
-    return cls(**initial_data)
+        handler_data = {'db_uri': 'file:/tmp/testdb.sqlite?mode=rw'} if logger_name == 'sqlite' else {}
+    return cls(**{**auth_data, **handler_data})
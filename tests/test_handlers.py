@@ -1,192 +1,395 @@
+import gc
+import logging
 import os
 import unittest
 
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 
 import sms
 from unittest.mock import patch, PropertyMock, Mock
 
 
+def remove_db(db_path):
+    sms.close_connections()
+    for suffix in ('', '-wal', '-shm'):
+        try:
+            os.remove(db_path + suffix)
+        except OSError:
+            pass
+
+
+class BaseSMSHandlerTestCase(unittest.TestCase):
+    @patch('sms.BaseSMSHandler.send')
+    def test_send_many(self, mock_send):
+        handler = sms.BaseSMSHandler('login', 'pass')
+        user_datas = [{'phone': str(79149009900 + i), 'message': 'text'} for i in range(10)]
+        handler.send_many(user_datas, concurrency=4)
+        self.assertEqual(mock_send.call_count, len(user_datas))
+        for user_data in user_datas:
+            mock_send.assert_any_call(user_data)
+
+    @patch('sms.handlers._HTTP.request', return_value=Mock(status=200,
+                                                           data=b'{"status": "ok", "phone": "79149009900"}'))
+    def test_send_many_with_db_logger(self, mock_request):
+        handler = sms.get_handler('smsr.ru', 'sqlite', {'db_uri': 'file::memory:'})
+        handler.conn.execute(handler.DDL)
+        handler.conn.commit()
+        user_datas = [{'phone': '79149009900', 'message': 'text'} for _ in range(10)]
+        handler.send_many(user_datas, concurrency=4)
+        self.assertEqual(handler._buf, [])
+        c = handler.conn.execute('SELECT Count(*) AS c FROM Results;')
+        self.assertEqual(c.fetchone(), (10,))
+
+    @patch('sms.BaseSMSHandler._log')
+    def test_log_dict(self, mock_log):
+        handler = sms.BaseSMSHandler('login', 'pass')
+        handler._log_dict({'status': 'error', 'phone': '79149009900', 'error_code': 3500, 'error_msg': 'description'})
+        mock_log.assert_called_once_with('error', '79149009900', 3500, 'description')
+        mock_log.reset_mock()
+        handler._log_dict({'status': 'ok', 'phone': '79149009900'})
+        mock_log.assert_called_once_with('ok', '79149009900', None, None)
+
+
+class HTTPTestCase(unittest.TestCase):
+    def test_requests_are_not_retried(self):
+        retries = sms.handlers._HTTP.connection_pool_kw['retries']
+        self.assertEqual(retries.connect, 0)
+        self.assertIs(retries.read, False)
+        self.assertEqual(retries.other, 0)
+
+    @patch('sms.handlers._HTTP.urlopen', return_value=Mock(status=200,
+                                                           data=b'{"status": "ok", "phone": "79149009900"}'))
+    @patch('sms.SMSCRU_SMSHandlerMixin._log', create=True)
+    @patch('sms.SMSCRU_SMSHandlerMixin.login', create=True, new_callable=PropertyMock, return_value='login')
+    @patch('sms.SMSCRU_SMSHandlerMixin.password', create=True, new_callable=PropertyMock, return_value='pass')
+    def test_encoded_query(self, mock_pass, mock_login, mock_log, mock_urlopen):
+        mixin = sms.SMSCRU_SMSHandlerMixin()
+        mixin.send({'phones': ['79149009900', '79149009901'], 'mes': 'text', 'sender': None})
+        method, url = mock_urlopen.call_args[0]
+        self.assertEqual(method, 'GET')
+        self.assertEqual(url, mixin.request_url + '?login=login&psw=pass&phones=79149009900&phones=79149009901&mes=text')
+
+    @patch('sms.handlers._HTTP.urlopen', return_value=Mock(status=200,
+                                                           data=b'{"status": "ok", "phone": "79149009900"}'))
+    @patch('sms.SMSTRAFFIC_SMSHandlerMixin._log', create=True)
+    @patch('sms.SMSTRAFFIC_SMSHandlerMixin._get_token', return_value='a')
+    def test_encoded_body(self, mock_token, mock_log, mock_urlopen):
+        mixin = sms.SMSTRAFFIC_SMSHandlerMixin()
+        mixin.send({'phone': ['79149009900', '79149009901'], 'message': 'text', 'sender': None})
+        self.assertEqual(mock_urlopen.call_args[0], ('POST', mixin.request_url))
+        self.assertEqual(mock_urlopen.call_args[1]['body'],
+                         'token=a&phone=79149009900&phone=79149009901&message=text')
+
+
 class SimpleLoggingMixinTestCase(unittest.TestCase):
     def test_log_without_status_in_response(self):
         mixin = sms.SimpleLoggingMixin()
-        response = {}
         with self.assertRaises(ValueError):
-            mixin._log(response)
+            mixin._log(None, '79149009900')
 
     def test_log_unxpected_value_of_status_in_response(self):
         mixin = sms.SimpleLoggingMixin()
-        response = {'status': None}
-        with self.assertRaises(ValueError):
-            mixin._log(response)
+        with self.assertRaises(RuntimeError):
+            mixin._log('', '79149009900')
+
+    def test_log_unknown_status_in_response(self):
+        mixin = sms.SimpleLoggingMixin()
+        with self.assertRaises(RuntimeError):
+            mixin._log('queued', '79149009900')
+
+    @patch('sms.SimpleLoggingMixin.logger')
+    def test_log_ok_response(self, mock_logger):
+        mixin = sms.SimpleLoggingMixin()
+        mixin._log('ok', '79149009900')
+        self.assertTrue(mock_logger.info.called)
 
-    @patch('logging.getLogger')
-    def test_log_ok_response(self, mock_logging):
+    @patch('sms.SimpleLoggingMixin.logger')
+    def test_log_error_response(self, mock_logger):
         mixin = sms.SimpleLoggingMixin()
-        response = {'status': 'ok', 'phone': '79149009900'}
-        mixin._log(response)
-        self.assertTrue(mock_logging.return_value.info.called)
+        mixin._log('error', '79149009900', 3500, 'description')
+        self.assertTrue(mock_logger.info.called)
 
-    @patch('logging.getLogger')
-    def test_log_error_response(self, mock_logging):
+    @patch('sms.SimpleLoggingMixin.logger')
+    def test_log_below_effective_level(self, mock_logger):
+        mock_logger.isEnabledFor.return_value = False
         mixin = sms.SimpleLoggingMixin()
-        response = {'status': 'error', 'phone': '79149009900', 'error_code': 3500, 'error_msg': 'description'}
-        mixin._log(response)
-        self.assertTrue(mock_logging.return_value.info.called)
+        mixin._log('ok', '79149009900')
+        mock_logger.isEnabledFor.assert_called_once_with(logging.INFO)
+        self.assertFalse(mock_logger.info.called)
 
 
 class SQLiteLoggingMixinTestCase(unittest.TestCase):
     def test_creation_of_db(self, uri='file::memory:'):
         mixin = sms.SQLiteLoggingMixin(uri)
-        mixin.c.execute(mixin.DDL)
-        mixin.c.connection.commit()
+        mixin.conn.execute(mixin.DDL)
+        mixin.conn.commit()
 
-        mixin.c.execute('SELECT Count(*) AS c FROM Results;')
-        self.assertEqual(mixin.c.fetchone(), (0,))
+        c = mixin.conn.execute('SELECT Count(*) AS c FROM Results;')
+        self.assertEqual(c.fetchone(), (0,))
         return mixin
 
     def test_creation_of_file_db(self):
         db_path = '/tmp/testdb.sqlite'
-        try:
-            os.remove(db_path)
-        except OSError:
-            pass
+        remove_db(db_path)
         self.test_creation_of_db('file:{}?mode=rwc'.format(db_path))
         self.assertTrue(os.path.isfile(db_path))
-        os.remove(db_path)
+        remove_db(db_path)
 
     def test_log_without_status_in_response(self):
         mixin = self.test_creation_of_db()
-        response = {}
         with self.assertRaises(ValueError):
-            mixin._log(response)
+            mixin._log(None, '79149009900')
 
     def test_log_unxpected_value_of_status_in_response(self):
         mixin = self.test_creation_of_db()
-        response = {'status': None}
         with self.assertRaises(ValueError):
-            mixin._log(response)
+            mixin._log('queued', '79149009900')
+        self.assertEqual(mixin._buf, [])
 
     def test_log_ok_response(self):
         mixin = self.test_creation_of_db()
-        response = {'status': 'ok', 'phone': '79149009900'}
-        mixin._log(response)
-        mixin.c.execute('SELECT success, phone AS c FROM Results;')
-        self.assertEqual(mixin.c.fetchone(), (1.0, response['phone']))
+        mixin._log('ok', '79149009900')
+        mixin.flush()
+        c = mixin.conn.execute('SELECT success, phone AS c FROM Results;')
+        self.assertEqual(c.fetchone(), (1.0, '79149009900'))
 
     def test_log_error_response(self):
         mixin = self.test_creation_of_db()
-        response = {'status': 'error', 'phone': '79149009900', 'error_code': 3500, 'error_msg': 'description'}
-        mixin._log(response)
-        mixin.c.execute('SELECT success, phone, error_code, error_msg AS c FROM Results;')
-        self.assertEqual(mixin.c.fetchone(), (0.0, response['phone'], response['error_code'], response['error_msg']))
+        mixin._log('error', '79149009900', 3500, 'description')
+        mixin.flush()
+        c = mixin.conn.execute('SELECT success, phone, error_code, error_msg AS c FROM Results;')
+        self.assertEqual(c.fetchone(), (0.0, '79149009900', 3500, 'description'))
+
+    def test_log_error_code_as_string(self):
+        mixin = self.test_creation_of_db()
+        mixin._log('error', '79149009900', '3500', 'description')
+        mixin.flush()
+        c = mixin.conn.execute('SELECT error_code, typeof(error_code) FROM Results;')
+        self.assertEqual(c.fetchone(), (3500, 'integer'))
+
+    def test_log_invalid_error_details(self):
+        mixin = self.test_creation_of_db()
+        with self.assertRaises(ValueError):
+            mixin._log('error', '79149009900', {'x': 1}, 'description')
+        with self.assertRaises(ValueError):
+            mixin._log('error', '79149009900', 3500, ['description'])
+        self.assertEqual(mixin._buf, [])
+
+    def test_failed_batch_does_not_block_later_writes(self):
+        mixin = self.test_creation_of_db()
+        mixin._batch_size = 2
+        mixin._log('ok', '79149009900')
+        mixin._buf.append((0, '79149009900', {'x': 1}, 'description'))
+        with self.assertLogs('sms', logging.ERROR):
+            mixin.flush()
+        self.assertEqual(mixin._buf, [])
+        mixin._log('ok', '79149009901')
+        mixin._log('ok', '79149009902')
+        c = mixin.conn.execute('SELECT phone FROM Results ORDER BY phone;')
+        self.assertEqual(c.fetchall(), [('79149009901',), ('79149009902',)])
+
+    def test_buffer_is_flushed_when_logger_is_collected(self):
+        mixin = self.test_creation_of_db()
+        conn = mixin.conn
+        mixin._log('ok', '79149009900')
+        self.assertIn(mixin, sms.handlers._LOGGERS)
+        del mixin
+        gc.collect()
+        self.assertEqual(conn.execute('SELECT Count(*) AS c FROM Results;').fetchone(), (0,))
+        sms.close_connections()
+        self.assertEqual(conn.execute('SELECT Count(*) AS c FROM Results;').fetchone(), (1,))
+
+    def test_collecting_logger_takes_no_locks(self):
+        db_path = '/tmp/testdb_collected.sqlite'
+        try:
+            mixin = self.test_creation_of_db('file:{}?mode=rwc'.format(db_path))
+            mixin._log('ok', '79149009900')
+            with sms.handlers._CACHE_LOCK, mixin._conn_lock:
+                del mixin
+                gc.collect()
+            other = self.test_creation_of_db('file::memory:')
+            other.flush()
+            conn = sqlite3.connect(db_path)
+            self.assertEqual(conn.execute('SELECT Count(*) AS c FROM Results;').fetchone(), (1,))
+            conn.close()
+        finally:
+            remove_db(db_path)
+
+    def test_close_connections_with_removed_db(self):
+        removed_path = '/tmp/testdb_removed.sqlite'
+        kept_path = '/tmp/testdb_kept.sqlite'
+        try:
+            removed = self.test_creation_of_db('file:{}?mode=rwc'.format(removed_path))
+            kept = self.test_creation_of_db('file:{}?mode=rwc'.format(kept_path))
+            removed._db_uri = 'file:{}?mode=rw'.format(removed_path)
+            removed._log('ok', '79149009900')
+            kept._log('ok', '79149009900')
+            for suffix in ('', '-wal', '-shm'):
+                os.remove(removed_path + suffix)
+            with self.assertLogs('sms', logging.ERROR):
+                sms.close_connections()
+            self.assertEqual(removed._buf, [])
+            conn = sqlite3.connect(kept_path)
+            self.assertEqual(conn.execute('SELECT Count(*) AS c FROM Results;').fetchone(), (1,))
+            conn.close()
+        finally:
+            remove_db(removed_path)
+            remove_db(kept_path)
+
+    def test_log_without_phone(self):
+        mixin = self.test_creation_of_db()
+        with self.assertRaises(ValueError):
+            mixin._log('ok', None)
+
+    def test_log_is_buffered_until_batch_size(self):
+        mixin = self.test_creation_of_db()
+        mixin._batch_size = 2
+        mixin._log('ok', '79149009900')
+        c = mixin.conn.execute('SELECT Count(*) AS c FROM Results;')
+        self.assertEqual(c.fetchone(), (0,))
+        mixin._log('ok', '79149009900')
+        c = mixin.conn.execute('SELECT Count(*) AS c FROM Results;')
+        self.assertEqual(c.fetchone(), (2,))
+        self.assertEqual(mixin._buf, [])
+
+    def test_connection_is_shared_for_file_db(self):
+        db_path = '/tmp/testdb_shared.sqlite'
+        db_uri = 'file:{}?mode=rwc'.format(db_path)
+        try:
+            first = sms.SQLiteLoggingMixin(db_uri)
+            second = sms.SQLiteLoggingMixin(db_uri)
+            self.assertIs(first.conn, second.conn)
+            self.assertIs(first._conn_lock, second._conn_lock)
+        finally:
+            remove_db(db_path)
+        self.assertFalse(os.path.exists(db_path + '-wal'))
+        self.assertFalse(os.path.exists(db_path + '-shm'))
+
+    def test_connection_is_replaced_for_recreated_file_db(self):
+        db_path = '/tmp/testdb_recreated.sqlite'
+        db_uri = 'file:{}?mode=rwc'.format(db_path)
+        try:
+            first = self.test_creation_of_db(db_uri)
+            for suffix in ('', '-wal', '-shm'):
+                os.remove(db_path + suffix)
+            second = self.test_creation_of_db(db_uri)
+            self.assertIsNot(first.conn, second.conn)
+            second._batch_size = 1
+            second._log('ok', '79149009900')
+            conn = sqlite3.connect(db_path)
+            self.assertEqual(conn.execute('SELECT Count(*) AS c FROM Results;').fetchone(), (1,))
+            conn.close()
+        finally:
+            remove_db(db_path)
+
+    def test_connection_is_not_shared_for_memory_db(self):
+        first = sms.SQLiteLoggingMixin('file::memory:')
+        second = sms.SQLiteLoggingMixin('file::memory:')
+        self.assertIsNot(first.conn, second.conn)
+
+    def test_log_from_several_threads(self):
+        mixin = self.test_creation_of_db()
+        mixin._batch_size = 7
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(mixin._log, ['ok'] * 100, ['79149009900'] * 100))
+        mixin.flush()
+        c = mixin.conn.execute('SELECT Count(*) AS c FROM Results;')
+        self.assertEqual(c.fetchone(), (100,))
 
 
 class SMSCRU_SMSHandlerMixinTestCase(unittest.TestCase):
-    @patch('requests.get', return_value=Mock(status_code=0))
+    @patch('sms.handlers._HTTP.request', return_value=Mock(status=0))
     @patch('sms.SMSCRU_SMSHandlerMixin._log', create=True)
     @patch('sms.SMSCRU_SMSHandlerMixin.login', create=True, new_callable=PropertyMock, return_value='login')
     @patch('sms.SMSCRU_SMSHandlerMixin.password', create=True, new_callable=PropertyMock, return_value='pass')
-    def test_send_invalid_HTTP_code_empty_user_data(self, mock_pass, mock_login, mock_log, mock_requests):
+    def test_send_invalid_HTTP_code_empty_user_data(self, mock_pass, mock_login, mock_log, mock_request):
         mixin = sms.SMSCRU_SMSHandlerMixin()
         user_data = {}
         mixin.send(user_data)
-        mock_log.assert_called_once_with({
-            'status': 'error',
-            'phone': '-',
-            'error_code': None,
-            'error_msg': 'data: {}'.format(user_data)
-        })
-
-    @patch('requests.get', return_value=Mock(status_code=0))
+        mock_log.assert_called_once_with('error', '-', None, 'data: {}'.format(user_data))
+
+    @patch('sms.handlers._HTTP.request', return_value=Mock(status=0))
     @patch('sms.SMSCRU_SMSHandlerMixin._log', create=True)
     @patch('sms.SMSCRU_SMSHandlerMixin.login', create=True, new_callable=PropertyMock, return_value='login')
     @patch('sms.SMSCRU_SMSHandlerMixin.password', create=True, new_callable=PropertyMock, return_value='pass')
-    def test_send_invalid_HTTP_code(self, mock_pass, mock_login, mock_log, mock_requests):
+    def test_send_invalid_HTTP_code(self, mock_pass, mock_login, mock_log, mock_request):
         mixin = sms.SMSCRU_SMSHandlerMixin()
         user_data = {'status': 'ok', 'phone': '79149009900'}
         mixin.send(user_data)
-        mock_log.assert_called_once_with({
-            'status': 'error',
-            'phone': user_data['phone'],
-            'error_code': None,
-            'error_msg': 'data: {}'.format(user_data)
-        })
-
-    @patch('requests.get', return_value=Mock(status_code=200,
-                                             json=lambda x=None: {'status': 'ok', 'phone': '79149009900'}))
+        mock_log.assert_called_once_with('error', user_data['phone'], None, 'data: {}'.format(user_data))
+
+    @patch('sms.handlers._HTTP.request', return_value=Mock(status=200,
+                                                           data=b'{"status": "ok", "phone": "79149009900"}'))
     @patch('sms.SMSCRU_SMSHandlerMixin._log', create=True)
     @patch('sms.SMSCRU_SMSHandlerMixin.login', create=True, new_callable=PropertyMock, return_value='login')
     @patch('sms.SMSCRU_SMSHandlerMixin.password', create=True, new_callable=PropertyMock, return_value='pass')
-    def test_send_valid_response(self, mock_pass, mock_login, mock_log, mock_requests):
+    def test_send_valid_response(self, mock_pass, mock_login, mock_log, mock_request):
         mixin = sms.SMSCRU_SMSHandlerMixin()
         user_data = {'status': 'ok', 'phone': '79149009900'}
         mixin.send(user_data)
-        mock_log.assert_called_once_with(user_data)
+        mock_log.assert_called_once_with('ok', '79149009900', None, None)
+        mock_request.assert_called_once_with(
+            'GET', mixin.request_url, fields=[('login', 'login'), ('psw', 'pass'), ('status', 'ok'), ('phone', '79149009900')])
 
 
 class SMSTRAFFIC_SMSHandlerMixinTestCase(unittest.TestCase):
-    @patch('requests.post', return_value=Mock(status_code=0, text='{"token": "a"}'))
+    @patch('sms.handlers._HTTP.request', return_value=Mock(status=0, data=b'{"token": "a"}'))
     @patch('sms.SMSTRAFFIC_SMSHandlerMixin.login', create=True, new_callable=PropertyMock, return_value='login')
     @patch('sms.SMSTRAFFIC_SMSHandlerMixin.password', create=True, new_callable=PropertyMock, return_value='pass')
-    def test_init_with_invalid_HTTP_code(self, mock_pass, mock_login, mock_requests):
+    def test_init_with_invalid_HTTP_code(self, mock_pass, mock_login, mock_request):
         with self.assertRaises(RuntimeError):
             mixin = sms.SMSTRAFFIC_SMSHandlerMixin()
 
-    @patch('requests.post', return_value=Mock(status_code=200, text='{}'))
+    @patch('sms.handlers._HTTP.request', return_value=Mock(status=200, data=b'{}'))
     @patch('sms.SMSTRAFFIC_SMSHandlerMixin.login', create=True, new_callable=PropertyMock, return_value='login')
     @patch('sms.SMSTRAFFIC_SMSHandlerMixin.password', create=True, new_callable=PropertyMock, return_value='pass')
-    def test_init_with_response_without_token(self, mock_pass, mock_login, mock_requests):
+    def test_init_with_response_without_token(self, mock_pass, mock_login, mock_request):
         with self.assertRaises(RuntimeError):
             mixin = sms.SMSTRAFFIC_SMSHandlerMixin()
 
-    @patch('requests.post', return_value=Mock(status_code=200, text='{"token": "a"}'))
+    @patch('sms.handlers._HTTP.request', return_value=Mock(status=200, data=b'{"token": "a"}'))
     @patch('sms.SMSTRAFFIC_SMSHandlerMixin.login', create=True, new_callable=PropertyMock, return_value='login')
     @patch('sms.SMSTRAFFIC_SMSHandlerMixin.password', create=True, new_callable=PropertyMock, return_value='pass')
-    def test_init_with_response_without_token(self, mock_pass, mock_login, mock_requests):
+    def test_init_with_response_without_token(self, mock_pass, mock_login, mock_request):
         mixin = sms.SMSTRAFFIC_SMSHandlerMixin()
         self.assertEqual(mixin.token, 'a')
         return mixin
 
-    @patch('requests.post', return_value=Mock(status_code=0, text='{}'))
+    @patch('sms.handlers._HTTP.request', return_value=Mock(status=0, data=b'{}'))
     @patch('sms.SMSTRAFFIC_SMSHandlerMixin._log', create=True)
     @patch('sms.SMSTRAFFIC_SMSHandlerMixin.login', create=True, new_callable=PropertyMock, return_value='login')
     @patch('sms.SMSTRAFFIC_SMSHandlerMixin.password', create=True, new_callable=PropertyMock, return_value='pass')
-    def test_send_invalid_HTTP_code_empty_user_data(self, mock_pass, mock_login, mock_log, mock_requests):
+    def test_send_invalid_HTTP_code_empty_user_data(self, mock_pass, mock_login, mock_log, mock_request):
         mixin = self.test_init_with_response_without_token()
         user_data = {}
         mixin.send(user_data)
-        mock_log.assert_called_once_with({
-            'status': 'error',
-            'phone': '-',
-            'error_code': None,
-            'error_msg': 'data: {}'.format(user_data)
-        })
-
-    @patch('requests.post', return_value=Mock(status_code=0, text='{"status": "ok", "phone": "79149009900"}'))
+        mock_log.assert_called_once_with('error', '-', None, 'data: {}'.format(user_data))
+
+    @patch('sms.handlers._HTTP.request', return_value=Mock(status=0,
+                                                           data=b'{"status": "ok", "phone": "79149009900"}'))
     @patch('sms.SMSTRAFFIC_SMSHandlerMixin._log', create=True)
     @patch('sms.SMSTRAFFIC_SMSHandlerMixin.login', create=True, new_callable=PropertyMock, return_value='login')
     @patch('sms.SMSTRAFFIC_SMSHandlerMixin.password', create=True, new_callable=PropertyMock, return_value='pass')
-    def test_send_invalid_HTTP_code(self, mock_pass, mock_login, mock_log, mock_requests):
+    def test_send_invalid_HTTP_code(self, mock_pass, mock_login, mock_log, mock_request):
         mixin = self.test_init_with_response_without_token()
         user_data = {'status': 'ok', 'phone': '79149009900'}
         mixin.send(user_data)
-        mock_log.assert_called_once_with({
-            'status': 'error',
-            'phone': user_data['phone'],
-            'error_code': None,
-            'error_msg': 'data: {}'.format(user_data)
-        })
-
-    @patch('requests.post', return_value=Mock(status_code=200, text='{"status": "ok", "phone": "79149009900"}'))
+        mock_log.assert_called_once_with('error', user_data['phone'], None, 'data: {}'.format(user_data))
+
+    @patch('sms.handlers._HTTP.request', return_value=Mock(status=200,
+                                                           data=b'{"status": "ok", "phone": "79149009900"}'))
     @patch('sms.SMSTRAFFIC_SMSHandlerMixin._log', create=True)
     @patch('sms.SMSTRAFFIC_SMSHandlerMixin.login', create=True, new_callable=PropertyMock, return_value='login')
     @patch('sms.SMSTRAFFIC_SMSHandlerMixin.password', create=True, new_callable=PropertyMock, return_value='pass')
-    def test_send_valid(self, mock_pass, mock_login, mock_log, mock_requests):
+    def test_send_valid(self, mock_pass, mock_login, mock_log, mock_request):
         mixin = self.test_init_with_response_without_token()
         user_data = {'status': 'ok', 'phone': '79149009900'}
         mixin.send(user_data)
-        mock_log.assert_called_once_with(user_data)
+        mock_log.assert_called_once_with('ok', '79149009900', None, None)
+        mock_request.assert_called_once_with(
+            'POST', mixin.request_url, fields=[('token', 'a'), ('status', 'ok'), ('phone', '79149009900')],
+            encode_multipart=False)
 
 
 class get_handlerMixinTestCase(unittest.TestCase):
@@ -206,10 +409,7 @@ class get_handlerMixinTestCase(unittest.TestCase):
 
     def test_create_handler_with_db_logger(self):
         db_path = '/tmp/testdb.sqlite'
-        try:
-            os.remove(db_path)
-        except OSError:
-            pass
+        remove_db(db_path)
         conn = sqlite3.connect(db_path)
         conn.close()
 
@@ -217,17 +417,27 @@ class get_handlerMixinTestCase(unittest.TestCase):
         self.assertIsInstance(handler, sms.SMSCRU_SMSHandlerMixin)
         self.assertIsInstance(handler, sms.BaseSMSHandler)
         self.assertIsInstance(handler, sms.SQLiteLoggingMixin)
-        os.remove(db_path)
+        remove_db(db_path)
 
     def test_create_handler_with_db_logger_with_additional_params(self):
         db_path = '/tmp/testdb.sqlite'
         db_uri = 'file::memory:'
-        try:
-            os.remove(db_path)
-        except OSError:
-            pass
+        remove_db(db_path)
         handler = sms.get_handler('smsr.ru', 'sqlite', {'db_uri': db_uri})
         self.assertIsInstance(handler, sms.SMSCRU_SMSHandlerMixin)
         self.assertIsInstance(handler, sms.BaseSMSHandler)
         self.assertIsInstance(handler, sms.SQLiteLoggingMixin)
         self.assertFalse(os.path.isfile(db_path))
+
+    def test_handler_class_is_reused(self):
+        first = sms.get_handler('smsr.ru')
+        second = sms.get_handler('smsr.ru')
+        self.assertIsNot(first, second)
+        self.assertIs(type(first), type(second))
+        self.assertIsNot(type(first), type(sms.get_handler('smsr.ru', 'sqlite', {'db_uri': 'file::memory:'})))
+
+    def test_handler_data_overrides_auth_data(self):
+        handler = sms.get_handler('smsr.ru', handler_data={'login': 'user', 'sender': 'shop'})
+        self.assertEqual(handler.login, 'user')
+        self.assertEqual(handler.password, 'pass')
+        self.assertEqual(handler.sender, 'shop')